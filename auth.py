@@ -1,27 +1,80 @@
+import asyncio
+import concurrent.futures
+import hmac
+import logging
+import os
 import uuid
 import bcrypt
-from supabase_client import supabase
+from postgrest.exceptions import APIError
+from supabase_client import async_supabase
+
+logger = logging.getLogger(__name__)
+
+UNIQUE_VIOLATION = "23505"
+# bcrypt's default cost; each +1 doubles the hashing time
+BCRYPT_ROUNDS = 10
+
+# bcrypt is CPU-bound; run it in worker processes so it never blocks the event loop.
+# Created lazily per process: a pool built at import under gunicorn --preload would be
+# forked into every worker, and the workers would then share (and corrupt) its pipes.
+_bcrypt_pool = None
+_bcrypt_pool_pid = None
+
+
+def _get_bcrypt_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _bcrypt_pool, _bcrypt_pool_pid
+    if _bcrypt_pool is None or _bcrypt_pool_pid != os.getpid():
+        _bcrypt_pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+        _bcrypt_pool_pid = os.getpid()
+    return _bcrypt_pool
+
+
+def shutdown_bcrypt_pool():
+    """Stop this process's bcrypt workers; called from the app lifespan on shutdown."""
+    global _bcrypt_pool
+    if _bcrypt_pool is not None and _bcrypt_pool_pid == os.getpid():
+        _bcrypt_pool.shutdown(wait=False, cancel_futures=True)
+    _bcrypt_pool = None
 
-# SIGNUP USER
-import uuid
-from supabase_client import supabase  # Already initialized
 
+def _verify_password(password: bytes, stored: bytes) -> bool:
+    if not stored.startswith(b"$2"):
+        # Accounts created before hashing was introduced still hold plaintext
+        return hmac.compare_digest(password, stored)
+    try:
+        return bcrypt.checkpw(password, stored)
+    except ValueError:
+        # Corrupt stored hash; a failed login, not a server error
+        return False
+
+
+def _hash_password(password: bytes) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+
+# SIGNUP USER
 async def signup_user(username: str,email: str ,password: str, preferences: str = None, diet_plan: str = None):
-    # Check if username already exists
-    existing_user = supabase.table('CustomUsers').select("*").eq('username', username).execute()
-    if existing_user.data:
-        return {"error": "Username already taken."}
+    loop = asyncio.get_running_loop()
+    hashed = await loop.run_in_executor(_get_bcrypt_pool(), _hash_password, password.encode())
 
-    # Insert new user with random UUID
+    # Insert new user with random UUID; the unique indexes on username/email
+    # reject duplicates in the same round trip, with no check-then-insert race
     new_user_id = str(uuid.uuid4())
-    response = supabase.table('CustomUsers').insert({
-        "user_id": new_user_id,
-        "username": username,
-        "email": email,
-        "password": password,
-        "preferences": preferences,
-        "diet_plan": diet_plan
-    }).execute()
+    try:
+        response = await async_supabase.table('CustomUsers').insert({
+            "user_id": new_user_id,
+            "username": username,
+            "email": email,
+            "password": hashed.decode(),
+            "preferences": preferences,
+            "diet_plan": diet_plan
+        }, returning='representation').execute()
+    except APIError as e:
+        if e.code == UNIQUE_VIOLATION:
+            if "idx_users_email" in (e.message or ""):
+                return {"error": "Email already registered."}
+            return {"error": "Username already taken."}
+        raise
 
     if response.data:
         return {
@@ -33,18 +86,37 @@ async def signup_user(username: str,email: str ,password: str, preferences: str
 
 
 async def login_user(email: str, password: str):
-    print("here")
-    user = supabase.table('CustomUsers') \
-        .select("*") \
+    user = await async_supabase.table('CustomUsers') \
+        .select("user_id,username,email,password") \
         .eq("email", email) \
-        .eq("password", password) \
         .limit(1) \
         .execute()
 
-    if user.data:
+    if not user.data:
+        logger.debug("login failed for %s: unknown email", email)
+        return None
+
+    row = user.data[0]
+    loop = asyncio.get_running_loop()
+    valid = await loop.run_in_executor(
+        _get_bcrypt_pool(), _verify_password, password.encode(), row['password'].encode()
+    )
+
+    if valid and not row['password'].startswith("$2"):
+        # Upgrade a legacy plaintext password to bcrypt now that we have the real value
+        hashed = await loop.run_in_executor(_get_bcrypt_pool(), _hash_password, password.encode())
+        try:
+            await async_supabase.table('CustomUsers') \
+                .update({"password": hashed.decode()}) \
+                .eq("user_id", row['user_id']) \
+                .execute()
+        except APIError:
+            logger.exception("failed to rehash legacy password for %s", row['user_id'])
+
+    if valid:
         return {
             "message": "Login successful.",
-            "user": user.data[0],
+            "user": row,
             "access_token": str(uuid.uuid4())
         }
     else:
@@ -1,21 +1,87 @@
 import os
-import json
-import re
+import orjson
+import base64
+import functools
+import hashlib
+import io
+import logging
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Dict, Any
 import google.generativeai as genai
-from PIL import Image
+from PIL import Image, ImageOps
+
+PROMPT = """
+            Extract each item purchased from this bill image, along with its numerical quantity and the unit of measurement (e.g., 'kg', 'g', 'ml', 'liter', 'pcs', 'dozen', 'packet', 'loaf', 'lb').
+
+            IMPORTANT INSTRUCTIONS:
+            1. Strip away ALL brand names, company names, and descriptive adjectives from item names
+            2. Keep only the core/generic item name (e.g., "California Crispy Apples" → "Apple", "Coca Cola" → "Cola", "Organic Free Range Eggs" → "Egg")
+            3. Use singular form for item names (e.g., "Apples" → "Apple", "Potatoes" → "Potato")
+            4. If a unit is not explicitly stated but a number is present, assume 'pcs' (pieces) as the default unit
+            5. Ignore prices, dates, store names, tax information, or other irrelevant information
+            6. Focus only on the items purchased and their quantities
+
+            For each item give item_name (generic item name without brands/adjectives, singular form),
+            quantity_value (number) and quantity_unit (unit like kg, g, ml, liter, pcs, dozen, packet, loaf, lb).
+
+            Example transformations:
+            - "California Crispy Apples" → "Apple"
+            - "Organic Free Range Eggs" → "Egg"
+            - "Coca Cola 500ml" → "Cola"
+            - "Wonder Bread Whole Wheat" → "Bread"
+            - "Dole Bananas" → "Banana"
+            - "Roma Tomatoes" → "Tomato"
+            - "Red Onions" → "Onion"
+            """
+
+logger = logging.getLogger(__name__)
+
+# Gemini decodes against this schema, so responses are always a bare JSON array
+ITEMS_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "item_name": {"type": "STRING"},
+            "quantity_value": {"type": "NUMBER"},
+            "quantity_unit": {"type": "STRING"}
+        },
+        "required": ["item_name", "quantity_value", "quantity_unit"]
+    }
+}
+GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": ITEMS_SCHEMA}
+
+# Receipts stay legible at this size; phone photos are usually 3-4x larger
+MAX_IMAGE_EDGE = 1600
+JPEG_QUALITY = 85
+
+# Gemini Batch Mode is only offered on the newer model family
+BATCH_MODEL = 'gemini-2.5-flash'
+
+@functools.lru_cache(maxsize=4)
+def _get_model(api_key: str):
+    """Share one GenerativeModel (and its HTTP connections) per API key."""
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel('gemini-1.5-flash', generation_config=GENERATION_CONFIG)
+
 
 class BillItemExtractor:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache_size: int = 1024):
         """
         Initialize the Bill Item Extractor with Gemini API key.
 
         Args:
             api_key (str): Google Gemini API key
+            cache_size (int): Number of extraction results to keep, keyed by image hash
         """
         self.api_key = api_key
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.model = _get_model(api_key)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
 
     def extract_items_from_bill(self, image_path: str) -> List[Dict[str, Any]]:
         """
@@ -28,93 +94,198 @@ class BillItemExtractor:
             List[Dict]: List of extracted items with quantities
         """
         try:
-            # Load and process the image
-            image = Image.open(image_path)
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+        except OSError:
+            logger.exception("Error reading bill image %s", image_path)
+            return []
+        return self.extract_items_from_bytes(image_bytes)
 
-            # Create the prompt for Gemini
-            prompt = """
-            Extract each item purchased from this bill image, along with its numerical quantity and the unit of measurement (e.g., 'kg', 'g', 'ml', 'liter', 'pcs', 'dozen', 'packet', 'loaf', 'lb').
+    def extract_items_from_bytes(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> List[Dict[str, Any]]:
+        """
+        Extract items from in-memory bill image bytes using Gemini API.
 
-            IMPORTANT INSTRUCTIONS:
-            1. Strip away ALL brand names, company names, and descriptive adjectives from item names
-            2. Keep only the core/generic item name (e.g., "California Crispy Apples" → "Apple", "Coca Cola" → "Cola", "Organic Free Range Eggs" → "Egg")
-            3. Use singular form for item names (e.g., "Apples" → "Apple", "Potatoes" → "Potato")
-            4. If a unit is not explicitly stated but a number is present, assume 'pcs' (pieces) as the default unit
-            5. Ignore prices, dates, store names, tax information, or other irrelevant information
-            6. Focus only on the items purchased and their quantities
+        Args:
+            image_bytes (bytes): Raw image file contents
+            mime_type (str): MIME type of image_bytes, used if the image cannot be re-encoded
 
-            Provide the output as a clean JSON array of objects, where each object has the following structure:
-            {
-              "item_name": "string (generic item name without brands/adjectives, singular form)",
-              "quantity_value": number,
-              "quantity_unit": "string (unit like kg, g, ml, liter, pcs, dozen, packet, loaf, lb)"
-            }
+        Returns:
+            List[Dict]: List of extracted items with quantities
+        """
+        try:
+            # Re-uploaded receipts skip Gemini entirely
+            digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+            cached = self._get_cached(digest)
+            if cached is not None:
+                return cached
 
-            Example transformations:
-            - "California Crispy Apples" → "Apple"
-            - "Organic Free Range Eggs" → "Egg"
-            - "Coca Cola 500ml" → "Cola"
-            - "Wonder Bread Whole Wheat" → "Bread"
-            - "Dole Bananas" → "Banana"
-            - "Roma Tomatoes" → "Tomato"
-            - "Red Onions" → "Onion"
+            # Load and process the image; formats Pillow cannot decode go to Gemini as-is
+            try:
+                image = {"mime_type": "image/jpeg", "data": self.prepare_image(image_bytes)}
+            except Image.UnidentifiedImageError:
+                image = {"mime_type": mime_type, "data": image_bytes}
 
-            Example output:
-            [
-              {"item_name": "Potato", "quantity_value": 2, "quantity_unit": "kg"},
-              {"item_name": "Egg", "quantity_value": 12, "quantity_unit": "pcs"},
-              {"item_name": "Milk", "quantity_value": 1, "quantity_unit": "liter"}
-            ]
-            """
+            # Create the prompt for Gemini
+            prompt = PROMPT
 
             # Generate content using Gemini
             response = self.model.generate_content([prompt, image])
+            extracted_items = self.parse_items_response(response.text)
+            if extracted_items:
+                self._set_cached(digest, extracted_items)
+            return extracted_items
 
-            # Extract and clean the JSON response
-            response_text = response.text.strip()
-
-            # Remove markdown code blocks if present
-            json_match = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL)
-            if json_match:
-                json_text = json_match.group(1)
-            else:
-                # Try to find JSON array directly
-                json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-                if json_match:
-                    json_text = json_match.group(0)
-                else:
-                    json_text = response_text
-
-            # Parse JSON
-            try:
-                extracted_items = json.loads(json_text)
-                return extracted_items if isinstance(extracted_items, list) else []
-            except json.JSONDecodeError as e:
-                print(f"JSON parsing error: {e}")
-                print(f"Response text: {response_text}")
-                return []
-
-        except Exception as e:
-            print(f"Error extracting items from bill: {str(e)}")
+        except Exception:
+            logger.exception("Error extracting items from bill image")
             return []
 
-    def create_json_output(self, extracted_items: List[Dict[str, Any]]) -> str:
+    def prepare_image(self, image_bytes: bytes) -> bytes:
         """
-        Create clean JSON output from extracted items.
+        Downscale and re-encode a bill image to shrink the upload to Gemini.
+
+        Args:
+            image_bytes (bytes): Raw image file contents
+
+        Returns:
+            bytes: JPEG bytes with the long edge capped at MAX_IMAGE_EDGE
+        """
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+        image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+        buf = io.BytesIO()
+        image.convert("RGB").save(buf, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        return buf.getvalue()
+
+    def _get_cached(self, digest: str):
+        with self._cache_lock:
+            items = self._cache.get(digest)
+            if items is None:
+                return None
+            self._cache.move_to_end(digest)
+        return [dict(item) for item in items]
+
+    def _set_cached(self, digest: str, items: List[Dict[str, Any]]):
+        with self._cache_lock:
+            self._cache[digest] = [dict(item) for item in items]
+            self._cache.move_to_end(digest)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def parse_items_response(self, response_text: str) -> List[Dict[str, Any]]:
+        """
+        Parse the item list out of a schema-constrained Gemini response.
+
+        Args:
+            response_text (str): Text returned by the model
+
+        Returns:
+            List[Dict]: Parsed items, or an empty list if the response is not valid JSON
+        """
+        try:
+            extracted_items = orjson.loads(response_text)
+            return extracted_items if isinstance(extracted_items, list) else []
+        except orjson.JSONDecodeError as e:
+            # Only a truncated response can fail here; the schema rules out anything else
+            logger.warning("JSON parsing error: %s", e)
+            logger.debug("Response text: %s", response_text)
+            return []
+
+    def extract_items_batch(self, image_paths: List[str], poll_interval: float = 30.0) -> List[List[Dict[str, Any]]]:
+        """
+        Extract items from many bill images with a single Gemini Batch Mode job.
+
+        Batch jobs are billed at half price but may take minutes to hours to
+        complete, so use this for bulk ingests and keep extract_items_from_bill
+        for interactive uploads.
+
+        Args:
+            image_paths (List[str]): Paths to the bill images
+            poll_interval (float): Seconds to wait between job status checks
+
+        Returns:
+            List[List[Dict]]: Extracted items per image, in the same order as image_paths
+        """
+        # The batch endpoints only exist in the newer google-genai SDK
+        from google import genai as google_genai
+
+        results: List[List[Dict[str, Any]]] = [[] for _ in image_paths]
+        if not image_paths:
+            return results
+
+        client = google_genai.Client(api_key=self.api_key)
+        jsonl_path = None
+        try:
+            with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False, encoding='utf-8') as f:
+                jsonl_path = f.name
+                for i, image_path in enumerate(image_paths):
+                    with open(image_path, 'rb') as img:
+                        data = base64.b64encode(self.prepare_image(img.read())).decode('ascii')
+                    request = {
+                        "key": f"bill_{i}",
+                        "request": {
+                            "contents": [{
+                                "parts": [
+                                    {"text": PROMPT},
+                                    {"inline_data": {"mime_type": "image/jpeg", "data": data}}
+                                ]
+                            }],
+                            "generation_config": GENERATION_CONFIG
+                        }
+                    }
+                    f.write(orjson.dumps(request).decode() + "\n")
+
+            uploaded = client.files.upload(file=jsonl_path, config={"mime_type": "jsonl"})
+            job = client.batches.create(model=BATCH_MODEL, src=uploaded.name)
+            logger.info("Submitted batch job %s for %d bills", job.name, len(image_paths))
+
+            done_states = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+            while job.state.name not in done_states:
+                time.sleep(poll_interval)
+                job = client.batches.get(name=job.name)
+
+            if job.state.name != "JOB_STATE_SUCCEEDED":
+                logger.error("Batch job %s ended with state %s", job.name, job.state.name)
+                return results
+
+            output = client.files.download(file=job.dest.file_name).decode('utf-8')
+            for line in output.splitlines():
+                if not line.strip():
+                    continue
+                entry = orjson.loads(line)
+                index = int(entry.get("key", "").rsplit("_", 1)[-1])
+                try:
+                    text = entry["response"]["candidates"][0]["content"]["parts"][0]["text"]
+                except (KeyError, IndexError):
+                    logger.warning("No result for %s: %s", image_paths[index], entry.get('error'))
+                    continue
+                results[index] = self.parse_items_response(text)
+
+            return results
+
+        except Exception:
+            logger.exception("Error running batch extraction")
+            return results
+        finally:
+            if jsonl_path and os.path.exists(jsonl_path):
+                os.unlink(jsonl_path)
+
+    def create_output(self, extracted_items: List[Dict[str, Any]], include_display: bool = False) -> Dict[str, Any]:
+        """
+        Build the clean result structure from extracted items.
 
         Args:
             extracted_items (List[Dict]): List of extracted items
+            include_display (bool): Also add a preformatted "quantity_display" string per item
 
         Returns:
-            str: JSON string of the results
+            Dict: Result with success flag, message, items and total_items
         """
         if not extracted_items:
-            return json.dumps({
+            return {
                 "success": False,
                 "message": "No items could be extracted from the bill image",
                 "items": [],
                 "total_items": 0
-            }, indent=2)
+            }
 
         # Create clean output structure
         output = {
@@ -126,40 +297,57 @@ class BillItemExtractor:
 
         # Process each item for clean JSON output
         for item in extracted_items:
+            value = item.get('quantity_value', 0)
+            unit = item.get('quantity_unit', 'pcs')
             clean_item = {
                 "name": item.get('item_name', 'Unknown Item'),
                 "quantity": {
-                    "value": item.get('quantity_value', 0),
-                    "unit": item.get('quantity_unit', 'pcs')
-                },
-                "quantity_display": f"{item.get('quantity_value', 0)} {item.get('quantity_unit', 'pcs')}"
+                    "value": value,
+                    "unit": unit
+                }
             }
+            if include_display:
+                clean_item["quantity_display"] = f"{value} {unit}"
             output['items'].append(clean_item)
 
-        return json.dumps(output, indent=2)
+        return output
+
+    def create_json_output(self, extracted_items: List[Dict[str, Any]], include_display: bool = False) -> str:
+        """
+        Create clean JSON output from extracted items.
+
+        Args:
+            extracted_items (List[Dict]): List of extracted items
+            include_display (bool): Also add a preformatted "quantity_display" string per item
+
+        Returns:
+            str: JSON string of the results
+        """
+        return orjson.dumps(self.create_output(extracted_items, include_display), option=orjson.OPT_INDENT_2).decode()
 
-    def extract_and_format(self, image_path: str) -> str:
+    def extract_and_format(self, image_path: str, include_display: bool = False) -> str:
         """
         Main function that extracts items from bill and returns formatted JSON output.
         This function calls both extract_items_from_bill and create_json_output.
 
         Args:
             image_path (str): Path to the bill image
+            include_display (bool): Also add a preformatted "quantity_display" string per item
 
         Returns:
             str: JSON string of the extraction results
         """
-        print(f"Processing bill image: {image_path}")
+        logger.info("Processing bill image: %s", image_path)
 
         # Step 1: Extract items from bill
-        print("Extracting items from bill...")
+        logger.debug("Extracting items from bill...")
         extracted_items = self.extract_items_from_bill(image_path)
 
         # Step 2: Create JSON output
-        print("Creating JSON output...")
-        json_output = self.create_json_output(extracted_items)
+        logger.debug("Creating JSON output...")
+        json_output = self.create_json_output(extracted_items, include_display)
 
-        print(f"Extraction complete! Found {len(extracted_items)} items.")
+        logger.info("Extraction complete! Found %d items.", len(extracted_items))
         return json_output
 
     def save_json_to_file(self, json_output: str, output_file: str) -> bool:
@@ -176,10 +364,10 @@ class BillItemExtractor:
         try:
             with open(output_file, 'w', encoding='utf-8') as f:
                 f.write(json_output)
-            print(f"✅ Results saved to: {output_file}")
+            logger.info("Results saved to: %s", output_file)
             return True
-        except Exception as e:
-            print(f"❌ Error saving JSON output: {str(e)}")
+        except Exception:
+            logger.exception("Error saving JSON output to %s", output_file)
             return False
 
 
@@ -195,8 +383,8 @@ def process_bill_json(json_file_path: str) -> Dict[str, Any]:
         Dict: Processed data for further use
     """
     try:
-        with open(json_file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(json_file_path, 'rb') as f:
+            data = orjson.loads(f.read())
 
         if not data['success']:
             return {"error": data['message']}
@@ -209,7 +397,7 @@ def process_bill_json(json_file_path: str) -> Dict[str, Any]:
                 'name': item['name'],
                 'quantity_value': item['quantity']['value'],
                 'quantity_unit': item['quantity']['unit'],
-                'display': item['quantity_display']
+                'display': item.get('quantity_display') or f"{item['quantity']['value']} {item['quantity']['unit']}"
             })
 
         return {
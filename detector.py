@@ -0,0 +1,423 @@
+"""
+YOLOv5 ingredient detector backends used by /detect-items/.
+
+The backend is picked from the weights file suffix:
+  - *.pt    PyTorch, using DetectMultiBackend from the local ./yolov5 repo
+  - *.onnx  ONNX Runtime, using the OpenVINO execution provider when installed
+  - *.engine  TensorRT on an NVIDIA GPU; class names are read from a
+              sidecar <weights>.names file, one name per line
+
+Export an optimized model once with the yolov5 repo, e.g.
+    python yolov5/export.py --weights new_weights/best.pt --include onnx
+and point YOLO_WEIGHTS at the result. The ONNX backend runs this FP32 model on the CPU:
+export.py only allows --half with --device 0, and FP16 is no faster on a CPU. There is no
+INT8 CPU backend; OpenVINO IR (--include openvino) is not loadable here.
+
+For TensorRT use --include engine --device 0 --half (export.py has no INT8 calibration
+path for engines; for INT8, export ONNX and build with trtexec --onnx=best.onnx --int8
+--calib=<calibration cache> --saveEngine=best.engine). export.py rejects --dynamic
+together with --half, so for an engine whose batch dimension DetectionBatcher can fill,
+export a dynamic ONNX and build the FP16 engine and its 1..32 profile with trtexec:
+    python yolov5/export.py --weights new_weights/best.pt --include onnx --dynamic
+    trtexec --onnx=best.onnx --fp16 --minShapes=images:1x3x640x640 --optShapes=images:16x3x640x640 --maxShapes=images:32x3x640x640 --saveEngine=best.engine
+"""
+import ast
+import asyncio
+import contextlib
+import os
+import pathlib
+import sys
+from typing import List
+
+import cv2
+import numpy as np
+from prometheus_client import Histogram
+
+IMG_SIZE = 640
+CONF_THRES = 0.25
+IOU_THRES = 0.45
+# Offset per class so one NMS pass never suppresses boxes across classes
+_CLASS_OFFSET = 4096
+
+# Used to tune DetectionBatcher's max_batch/max_wait against real traffic
+DETECT_BATCH_SIZE = Histogram(
+    'detect_batch_size', 'Images per detector forward pass', buckets=(1, 2, 4, 8, 16, 32))
+
+
+def letterbox(img: np.ndarray, new_size: int = IMG_SIZE, color=(114, 114, 114)):
+    """
+    Resize an HWC image keeping its aspect ratio and pad it to a square canvas.
+
+    Returns:
+        tuple: (padded image, scale ratio, (pad_left, pad_top))
+    """
+    h, w = img.shape[:2]
+    r = min(new_size / h, new_size / w)
+    nh, nw = round(h * r), round(w * r)
+    if (nh, nw) != (h, w):
+        img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+
+    top, left = (new_size - nh) // 2, (new_size - nw) // 2
+    out = cv2.copyMakeBorder(img, top, new_size - nh - top, left, new_size - nw - left,
+                             cv2.BORDER_CONSTANT, value=color)
+    return out, r, (left, top)
+
+
+def non_max_suppression(pred: np.ndarray, conf_thres: float = CONF_THRES, iou_thres: float = IOU_THRES) -> np.ndarray:
+    """
+    Class-aware NMS over one image's raw YOLOv5 output of shape (N, 5 + num_classes).
+
+    Returns:
+        np.ndarray: (M, 6) array of x1, y1, x2, y2, confidence, class
+    """
+    pred = pred[pred[:, 4] > conf_thres]
+    if not len(pred):
+        return np.zeros((0, 6), dtype=np.float32)
+
+    scores = pred[:, 5:] * pred[:, 4:5]
+    cls = scores.argmax(1)
+    conf = scores[np.arange(len(scores)), cls]
+    mask = conf > conf_thres
+    pred, cls, conf = pred[mask], cls[mask], conf[mask]
+
+    boxes = np.empty((len(pred), 4), dtype=np.float32)
+    boxes[:, :2] = pred[:, :2] - pred[:, 2:4] / 2
+    boxes[:, 2:] = pred[:, :2] + pred[:, 2:4] / 2
+
+    shifted = boxes + (cls * _CLASS_OFFSET)[:, None]
+    areas = (shifted[:, 2] - shifted[:, 0]) * (shifted[:, 3] - shifted[:, 1])
+    order = conf.argsort()[::-1]
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        xx1 = np.maximum(shifted[i, 0], shifted[rest, 0])
+        yy1 = np.maximum(shifted[i, 1], shifted[rest, 1])
+        xx2 = np.minimum(shifted[i, 2], shifted[rest, 2])
+        yy2 = np.minimum(shifted[i, 3], shifted[rest, 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_thres]
+
+    return np.concatenate([boxes[keep], conf[keep, None], cls[keep, None]], axis=1).astype(np.float32)
+
+
+def scale_boxes(det: np.ndarray, r: float, pad) -> np.ndarray:
+    """Map boxes from letterboxed coordinates back onto the original image."""
+    left, top = pad
+    det[:, [0, 2]] -= left
+    det[:, [1, 3]] -= top
+    det[:, :4] /= r
+    return det
+
+
+YOLOV5_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yolov5')
+
+
+@contextlib.contextmanager
+def _posix_checkpoint_paths():
+    """
+    Let a checkpoint pickled on Linux (it holds PosixPath objects) unpickle on Windows.
+    The patch only lives for the duration of the load.
+    """
+    if os.name != 'nt':
+        yield
+        return
+    posix_path = pathlib.PosixPath
+    pathlib.PosixPath = pathlib.WindowsPath
+    try:
+        yield
+    finally:
+        pathlib.PosixPath = posix_path
+
+
+class TorchDetector:
+    def __init__(self, weights: str):
+        """
+        Load a YOLOv5 checkpoint with the local repo's DetectMultiBackend.
+
+        Args:
+            weights (str): Path to the .pt checkpoint
+        """
+        import torch
+        # yolov5 imports its own modules as top-level `models`/`utils`
+        if YOLOV5_DIR not in sys.path:
+            sys.path.insert(0, YOLOV5_DIR)
+        from models.common import DetectMultiBackend
+
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.cuda = self.device == 'cuda'
+        # Loaded directly instead of through torch.hub; Conv+BN layers are fused on load and
+        # the weights are cast to FP16 once on CUDA, so inputs only need .half()
+        with _posix_checkpoint_paths():
+            self.net = DetectMultiBackend(weights, device=torch.device(self.device), fp16=self.cuda, fuse=True)
+        self.net.eval()
+        self.names = self.net.names
+        self._host_in = None
+
+        if self.cuda:
+            # Inputs are always letterboxed to IMG_SIZE, so cuDNN can autotune once
+            torch.backends.cudnn.benchmark = True
+
+        # Pay kernel selection/allocation costs at startup instead of on the first request
+        self.predict([np.zeros((IMG_SIZE, IMG_SIZE, 3), dtype=np.uint8)])
+
+    def _staging(self, n: int):
+        import torch
+        # Page-locked so the host->device upload is an async DMA; grown only when a larger batch arrives
+        if self._host_in is None or self._host_in.shape[0] < n:
+            self._host_in = torch.empty((n, IMG_SIZE, IMG_SIZE, 3), dtype=torch.uint8, pin_memory=self.cuda)
+        return self._host_in[:n]
+
+    @staticmethod
+    def _nms(pred):
+        import torch
+        import torchvision
+        pred = pred[pred[:, 4] > CONF_THRES]
+        conf, cls = (pred[:, 5:] * pred[:, 4:5]).max(1)
+        mask = conf > CONF_THRES
+        pred, conf, cls = pred[mask].float(), conf[mask].float(), cls[mask]
+
+        boxes = torch.cat([pred[:, :2] - pred[:, 2:4] / 2, pred[:, :2] + pred[:, 2:4] / 2], 1)
+        keep = torchvision.ops.batched_nms(boxes, conf, cls, IOU_THRES)
+        return torch.cat([boxes[keep], conf[keep, None], cls[keep, None].float()], 1)
+
+    def predict(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Run detection on RGB HWC images.
+
+        Returns:
+            List[np.ndarray]: Per-image (M, 6) arrays of x1, y1, x2, y2, confidence, class
+        """
+        import torch
+        host_in = self._staging(len(images))
+        transforms = []
+        for i, img in enumerate(images):
+            padded, r, pad = letterbox(img)
+            host_in[i] = torch.from_numpy(padded)
+            transforms.append((r, pad))
+
+        with torch.inference_mode():
+            x = host_in.to(self.device, non_blocking=True).permute(0, 3, 1, 2)
+            x = (x.half() if self.cuda else x.float()) / 255
+            pred = self.net(x)
+            if isinstance(pred, (list, tuple)):
+                pred = pred[0]
+            # NMS on the device, so only the final (M, 6) boxes cross PCIe, in one copy
+            dets = [self._nms(p) for p in pred]
+            flat = torch.cat(dets)
+            host_out = torch.empty(flat.shape, dtype=flat.dtype, pin_memory=self.cuda)
+            host_out.copy_(flat, non_blocking=True)
+            if self.cuda:
+                torch.cuda.current_stream().synchronize()
+
+        out = np.split(host_out.numpy(), np.cumsum([len(d) for d in dets])[:-1])
+        return [scale_boxes(det.copy(), r, pad) for det, (r, pad) in zip(out, transforms)]
+
+
+class OnnxDetector:
+    def __init__(self, weights: str):
+        """
+        Load an exported YOLOv5 ONNX model into an ONNX Runtime session.
+
+        Args:
+            weights (str): Path to the .onnx file produced by yolov5/export.py
+        """
+        import onnxruntime as ort
+        available = ort.get_available_providers()
+        providers = [p for p in ("OpenVINOExecutionProvider", "CPUExecutionProvider") if p in available]
+        self.session = ort.InferenceSession(weights, providers=providers)
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.dtype = np.float16 if model_input.type == 'tensor(float16)' else np.float32
+        # Exports without --dynamic have a fixed batch size of 1
+        self.static_batch = isinstance(model_input.shape[0], int)
+        # yolov5/export.py stores the class names as a dict literal in the model metadata
+        self.names = ast.literal_eval(self.session.get_modelmeta().custom_metadata_map['names'])
+        # Input tensor reused across calls; grown if a larger batch comes in
+        self._buffer = np.empty((1, 3, IMG_SIZE, IMG_SIZE), dtype=self.dtype)
+
+    def predict(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Run detection on RGB HWC images.
+
+        Returns:
+            List[np.ndarray]: Per-image (M, 6) arrays of x1, y1, x2, y2, confidence, class
+        """
+        if len(images) > len(self._buffer):
+            self._buffer = np.empty((len(images), 3, IMG_SIZE, IMG_SIZE), dtype=self.dtype)
+        batch = self._buffer[:len(images)]
+        transforms = []
+        for i, img in enumerate(images):
+            padded, r, pad = letterbox(img)
+            batch[i] = padded.transpose(2, 0, 1)
+            transforms.append((r, pad))
+        batch /= 255
+
+        if self.static_batch:
+            preds = [self.session.run(None, {self.input_name: batch[i:i + 1]})[0][0] for i in range(len(images))]
+        else:
+            preds = self.session.run(None, {self.input_name: batch})[0]
+
+        return [scale_boxes(non_max_suppression(pred.astype(np.float32)), r, pad)
+                for pred, (r, pad) in zip(preds, transforms)]
+
+
+class TensorRTDetector:
+    def __init__(self, weights: str):
+        """
+        Deserialize a YOLOv5 TensorRT engine and allocate its I/O buffers once.
+
+        Args:
+            weights (str): Path to the .engine file produced by yolov5/export.py
+        """
+        import tensorrt as trt
+        import pycuda.driver as cuda
+        self._cuda = cuda
+
+        cuda.init()
+        # Own the context so predict() can run from any worker thread
+        self._ctx = cuda.Device(0).make_context()
+        try:
+            with open(weights, 'rb') as f, trt.Runtime(trt.Logger(trt.Logger.WARNING)) as runtime:
+                self.engine = runtime.deserialize_cuda_engine(f.read())
+            self.context = self.engine.create_execution_context()
+            self.stream = cuda.Stream()
+
+            names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+            self.input_name = next(n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT)
+            self.output_name = next(n for n in names if n != self.input_name)
+
+            # Engines exported with --dynamic have a -1 batch dim; size buffers for the profile max
+            in_shape = list(self.engine.get_tensor_shape(self.input_name))
+            out_shape = list(self.engine.get_tensor_shape(self.output_name))
+            self.dynamic_batch = in_shape[0] == -1
+            self.max_batch = self.engine.get_tensor_profile_shape(self.input_name, 0)[2][0] if self.dynamic_batch else in_shape[0]
+            in_shape[0] = out_shape[0] = self.max_batch
+
+            # Page-locked host buffers make the async copies real DMA transfers
+            self._host_in = cuda.pagelocked_empty(
+                tuple(in_shape), trt.nptype(self.engine.get_tensor_dtype(self.input_name)))
+            self._host_out = cuda.pagelocked_empty(
+                tuple(out_shape), trt.nptype(self.engine.get_tensor_dtype(self.output_name)))
+            self._dev_in = cuda.mem_alloc(self._host_in.nbytes)
+            self._dev_out = cuda.mem_alloc(self._host_out.nbytes)
+            self.context.set_tensor_address(self.input_name, int(self._dev_in))
+            self.context.set_tensor_address(self.output_name, int(self._dev_out))
+        finally:
+            self._ctx.pop()
+
+        with open(os.path.splitext(weights)[0] + '.names', encoding='utf-8') as f:
+            self.names = [line.strip() for line in f if line.strip()]
+
+    def predict(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Run detection on RGB HWC images.
+
+        Returns:
+            List[np.ndarray]: Per-image (M, 6) arrays of x1, y1, x2, y2, confidence, class
+        """
+        cuda = self._cuda
+        detections = []
+        self._ctx.push()
+        try:
+            for start in range(0, len(images), self.max_batch):
+                chunk = images[start:start + self.max_batch]
+                n = len(chunk) if self.dynamic_batch else self.max_batch
+                transforms = []
+                for i, img in enumerate(chunk):
+                    padded, r, pad = letterbox(img)
+                    self._host_in[i] = padded.transpose(2, 0, 1)
+                    transforms.append((r, pad))
+                host_in, host_out = self._host_in[:n], self._host_out[:n]
+                host_in /= 255
+
+                if self.dynamic_batch:
+                    self.context.set_input_shape(self.input_name, host_in.shape)
+                cuda.memcpy_htod_async(self._dev_in, host_in, self.stream)
+                self.context.execute_async_v3(stream_handle=self.stream.handle)
+                cuda.memcpy_dtoh_async(host_out, self._dev_out, self.stream)
+                self.stream.synchronize()
+
+                for pred, (r, pad) in zip(host_out, transforms):
+                    detections.append(scale_boxes(non_max_suppression(pred.astype(np.float32)), r, pad))
+        finally:
+            self._ctx.pop()
+        return detections
+
+
+class DetectionBatcher:
+    def __init__(self, detector, max_batch: int = 16, max_wait: float = 0.005):
+        """
+        Coalesce concurrent detection requests into a single forward pass.
+
+        Args:
+            detector: Backend exposing predict(images) -> per-image detections
+            max_batch (int): Largest number of images run together
+            max_wait (float): Seconds to wait for more requests after the first arrives
+        """
+        self.detector = detector
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def detect(self, image: np.ndarray) -> np.ndarray:
+        """Queue one RGB HWC image and wait for its (M, 6) detections."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            DETECT_BATCH_SIZE.observe(len(batch))
+            try:
+                # Inference is blocking, keep it off the event loop
+                results = await asyncio.to_thread(self.detector.predict, [image for image, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), det in zip(batch, results):
+                if not future.done():
+                    future.set_result(det)
+
+
+def load_detector(weights: str):
+    """
+    Build the detector backend matching the weights file type.
+
+    Args:
+        weights (str): Path to a .pt checkpoint or an exported .onnx/.engine model
+    """
+    if weights.endswith('.onnx'):
+        return OnnxDetector(weights)
+    if weights.endswith('.engine'):
+        return TensorRTDetector(weights)
+    return TorchDetector(weights)
@@ -1,22 +1,26 @@
-# -------------------------
-# CODE 1 (UNCHANGED)
-# -------------------------
-from fastapi import APIRouter, UploadFile, File
-from supabase_client import supabase
+import logging
+import pathlib
+import tempfile
+from typing import Optional
+import aiofiles
+from fastapi import APIRouter, UploadFile, File, HTTPException
+from pydantic import BaseModel, ConfigDict
+from supabase_client import async_supabase
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # Add ingredient - matches SQL schema exactly
-from pydantic import BaseModel
-
 class Ingredient(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
     user_id: str
     name: str
     quantity: int
 
 @router.post("/add_ingredient/")
 async def add_ingredient(ingredient: Ingredient):
-    response = supabase.table('Ingredients Inventory').insert({
+    response = await async_supabase.table('Ingredients Inventory').insert({
         "user_id": ingredient.user_id,
         "Name": ingredient.name,
         "Quantity": ingredient.quantity
@@ -29,10 +33,9 @@ async def add_ingredient(ingredient: Ingredient):
 # Get all ingredients by user_id
 @router.get("/get_ingredients/{user_id}")
 async def get_ingredients(user_id: str):
-    print("HERE")
-    response = supabase.table('Ingredients Inventory').select("*").eq('user_id', user_id).execute()
+    response = await async_supabase.table('Ingredients Inventory').select("id,Name,Quantity,Units").eq('user_id', user_id).execute()
     if response.data:
-        print(response.data)
+        logger.debug("ingredients for %s: %d rows", user_id, len(response.data))
         return {"ingredients": response.data}
     else:
         return {"message": "No ingredients found"}
@@ -40,7 +43,7 @@ async def get_ingredients(user_id: str):
 # Get user profile
 @router.get("/get_profile/{user_id}")
 async def get_profile(user_id: str):
-    response = supabase.table('CustomUsers').select("*").eq('user_id', user_id).execute()
+    response = await async_supabase.table('CustomUsers').select("user_id,username,email,preferences,diet_plan").eq('user_id', user_id).execute()
     if response.data:
         return {"profile": response.data[0]}
     else:
@@ -49,22 +52,25 @@ async def get_profile(user_id: str):
 # Detect ingredient (mocked)
 @router.post("/detect_ingredient/")
 async def detect_ingredient(image: UploadFile = File(...)):
-    file_location = f"temp{image.filename}"
-    with open(file_location, "wb+") as file_object:
-        file_object.write(await image.read())
+    # Keep only the base name so a crafted filename cannot escape the temp dir
+    file_location = pathlib.Path(tempfile.gettempdir()) / f"temp{pathlib.Path(image.filename or '').name}"
+    async with aiofiles.open(file_location, "wb") as file_object:
+        while chunk := await image.read(1 << 16):
+            await file_object.write(chunk)
     # Mocked detection
     detected_ingredient = "Tomato"
     return {"detected_ingredient": detected_ingredient}
 
+class IngredientUpdate(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
 
-# -------------------------
-# CODE 2 (MODIFIED TO MATCH SCHEMA)
-# -------------------------
-from fastapi import HTTPException
-from pydantic import BaseModel
-from typing import Optional
+    name: Optional[str] = None
+    quantity: Optional[int] = None
 
-class IngredientUpdate(BaseModel):
+class IngredientBulkItem(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
+    id: int
     name: Optional[str] = None
     quantity: Optional[int] = None
 
@@ -81,94 +87,85 @@ async def update_ingredient(ingredient_id: int, ingredient: IngredientUpdate):
         if not update_data:
             raise HTTPException(status_code=400, detail="No fields to update")
         
-        response = supabase.table('Ingredients Inventory').update(update_data).eq('id', ingredient_id).execute()
+        response = await async_supabase.table('Ingredients Inventory').update(update_data).eq('id', ingredient_id).execute()
         if response.data:
             return {"success": True, "message": "Ingredient updated successfully", "ingredient": response.data[0]}
         else:
             raise HTTPException(status_code=404, detail="Ingredient not found")
-    except Exception as e:
-        print(f"Error updating ingredient: {e}")
+    except Exception:
+        logger.exception("Error updating ingredient %s", ingredient_id)
         raise HTTPException(status_code=500, detail="Failed to update ingredient")
 
 @router.delete("/delete_ingredient/{ingredient_id}")
 async def delete_ingredient(ingredient_id: int):
     """Delete an ingredient"""
     try:
-        response = supabase.table('Ingredients Inventory').delete().eq('id', ingredient_id).execute()
+        response = await async_supabase.table('Ingredients Inventory').delete().eq('id', ingredient_id).execute()
         if response.data:
             return {"success": True, "message": "Ingredient deleted successfully"}
         else:
             raise HTTPException(status_code=404, detail="Ingredient not found")
-    except Exception as e:
-        print(f"Error deleting ingredient: {e}")
+    except Exception:
+        logger.exception("Error deleting ingredient %s", ingredient_id)
         raise HTTPException(status_code=500, detail="Failed to delete ingredient")
 
 @router.get("/get_ingredient/{ingredient_id}")
 async def get_ingredient(ingredient_id: int):
     """Get a specific ingredient"""
     try:
-        response = supabase.table('Ingredients Inventory').select("*").eq('id', ingredient_id).execute()
+        response = await async_supabase.table('Ingredients Inventory').select("id,Name,Quantity,Units,user_id").eq('id', ingredient_id).execute()
         if response.data:
             return {"success": True, "ingredient": response.data[0]}
         else:
             raise HTTPException(status_code=404, detail="Ingredient not found")
-    except Exception as e:
-        print(f"Error fetching ingredient: {e}")
+    except Exception:
+        logger.exception("Error fetching ingredient %s", ingredient_id)
         raise HTTPException(status_code=500, detail="Failed to fetch ingredient")
 
 @router.put("/update_ingredient_quantity/{ingredient_id}")
 async def update_ingredient_quantity(ingredient_id: int, quantity_change: int):
     """Increase or decrease ingredient quantity"""
     try:
-        current = supabase.table('Ingredients Inventory').select("*").eq('id', ingredient_id).execute()
-        if not current.data:
+        # Atomic increment clamped at 0, done in a single round trip
+        update = await async_supabase.rpc('increment_ingredient_qty', {"ing_id": ingredient_id, "delta": quantity_change}).execute()
+        if not update.data:
             raise HTTPException(status_code=404, detail="Ingredient not found")
-        
-        new_quantity = current.data[0]['Quantity'] + quantity_change
-        if new_quantity < 0:
-            new_quantity = 0
-        
-        update = supabase.table('Ingredients Inventory').update({'Quantity': new_quantity}).eq('id', ingredient_id).execute()
-        if update.data:
-            return {
-                "success": True,
-                "message": f"Quantity updated to {new_quantity}",
-                "ingredient": update.data[0]
-            }
-        else:
-            raise HTTPException(status_code=400, detail="Failed to update quantity")
-    except Exception as e:
-        print(f"Error updating quantity: {e}")
+
+        ingredient = update.data[0]
+        return {
+            "success": True,
+            "message": f"Quantity updated to {ingredient['Quantity']}",
+            "ingredient": ingredient
+        }
+    except Exception:
+        logger.exception("Error updating quantity for ingredient %s", ingredient_id)
         raise HTTPException(status_code=500, detail="Failed to update quantity")
 
 @router.get("/search_ingredients/{user_id}")
 async def search_ingredients(user_id: str, query: str):
     """Search ingredients by name"""
     try:
-        response = supabase.table('Ingredients Inventory').select("*").eq('user_id', user_id).ilike('Name', f'%{query}%').execute()
+        response = await async_supabase.table('Ingredients Inventory').select("*").eq('user_id', user_id).ilike('Name', f'%{query}%').execute()
         return {"success": True, "ingredients": response.data or [], "count": len(response.data) if response.data else 0}
-    except Exception as e:
-        print(f"Error searching: {e}")
+    except Exception:
+        logger.exception("Error searching ingredients for %s", user_id)
         raise HTTPException(status_code=500, detail="Failed to search ingredients")
 
 @router.post("/bulk_update_ingredients/{user_id}")
-async def bulk_update_ingredients(user_id: str, ingredients: list[dict]):
+async def bulk_update_ingredients(user_id: str, ingredients: list[IngredientBulkItem]):
     """Bulk update ingredients"""
     try:
+        # One round trip: the SQL function applies every row and keeps the user_id ownership check
+        items = [
+            {"id": data.id, "name": data.name, "quantity": data.quantity}
+            for data in ingredients
+            if data.name is not None or data.quantity is not None
+        ]
         updated = []
-        for data in ingredients:
-            if not data.get('id'):
-                continue
-            update_data = {}
-            if 'name' in data:
-                update_data['Name'] = data['name']
-            if 'quantity' in data:
-                update_data['Quantity'] = data['quantity']
-            if update_data:
-                resp = supabase.table('Ingredients Inventory').update(update_data).eq('id', data['id']).eq('user_id', user_id).execute()
-                if resp.data:
-                    updated.extend(resp.data)
+        if items:
+            resp = await async_supabase.rpc('bulk_update_ingredients', {"p_user": user_id, "p_items": items}).execute()
+            updated = resp.data or []
         return {"success": True, "message": f"Updated {len(updated)} ingredients", "ingredients": updated}
-    except Exception as e:
-        print(f"Error bulk updating: {e}")
+    except Exception:
+        logger.exception("Error bulk updating ingredients for %s", user_id)
         raise HTTPException(status_code=500, detail="Failed to bulk update")
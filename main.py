@@ -1,36 +1,62 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from typing import Optional, Dict
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
-import re
-import json
+from prometheus_client import CollectorRegistry, make_asgi_app, multiprocess
+import orjson
 import os
-import tempfile
+import asyncio
+import functools
 import logging
-import pathlib
-import torch
 import numpy as np
 from PIL import Image
-import io
-import google.generativeai as genai
 from dotenv import load_dotenv
 from enum import Enum
 
-from auth import signup_user, login_user
+from auth import signup_user, login_user, shutdown_bcrypt_pool
 from inventory import router as inventory_router
-from supabase_client import supabase
+from supabase_client import async_supabase, check_connection, http_client
 from bill_extract import BillItemExtractor
+from recipe_generator import API_KEY, InventoryUpdateItem, generate_recipe, stream_recipe_fields, update_ingredients_inventory
+from detector import load_detector, DetectionBatcher, IMG_SIZE
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
 
 # ---------------- YOLO MODEL LOAD ----------------
-pathlib.PosixPath = pathlib.WindowsPath
-yolo_model = torch.hub.load('./yolov5', 'custom', path='new_weights/best.pt', source='local')
-print("✅ YOLO model loaded")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Opt-in so a Supabase hiccup never blocks or slows worker boot
+    if os.getenv("SUPABASE_HEALTHCHECK"):
+        await check_connection()
+    # Loaded per worker at startup rather than at import time
+    # Set YOLO_WEIGHTS to an exported .onnx/.engine model to use ONNX Runtime/OpenVINO or TensorRT
+    app.state.yolo = load_detector(os.getenv('YOLO_WEIGHTS', 'new_weights/best.pt'))
+    logger.info("YOLO model loaded")
+    app.state.detection_batcher = DetectionBatcher(app.state.yolo)
+    app.state.detection_batcher.start()
+    yield
+    await app.state.detection_batcher.stop()
+    await http_client.aclose()
+    shutdown_bcrypt_pool()
 
 # ---------------- FASTAPI APP ----------------
 load_dotenv()
-app = FastAPI()
+# orjson serialises every JSON response (recipes, bill items) instead of the stdlib encoder
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 app.include_router(inventory_router)
+# Prometheus scrape endpoint (detector batch-size histogram)
+# Each gunicorn worker has its own registry, so a plain scrape only sees whichever worker
+# answered it. With PROMETHEUS_MULTIPROC_DIR set, metrics are written to files there and
+# every scrape aggregates all workers.
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    metrics_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(metrics_registry)
+    app.mount("/metrics", make_asgi_app(registry=metrics_registry))
+else:
+    app.mount("/metrics", make_asgi_app())
 
 app.add_middleware(
     CORSMiddleware,
@@ -40,14 +66,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-API_KEY = os.getenv('GEMINI_API')
-if not API_KEY:
-    raise RuntimeError("❌ GEMINI_API_KEY not found in .env")
-
-# Gemini API configuration
-genai.configure(api_key=API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")
-
 class SignupRequest(BaseModel):
     username: str
     password: str
@@ -68,165 +86,10 @@ class RecipeRequest(BaseModel):
     user_id: str
     meal_type: MealType
 
-class InventoryUpdateItem(BaseModel):
-    quantity: float
-    units: str
-
 class UpdateInventoryRequest(BaseModel):
     user_id: str
     updated_inventory: Dict[str, InventoryUpdateItem]  # {"ingredient_name": {"quantity": new_quantity, "units": "g"}}
 
-# Recipe generator functions
-def clean_json_response(text):
-    clean_text = re.sub(r'```(?:json)?', '', text).strip()
-    clean_text = re.sub(r'```$', '', clean_text).strip()
-    return clean_text
-
-def fetch_ingredients_for_user(user_id):
-    response = supabase.table('Ingredients Inventory').select("*").eq('user_id', user_id).execute()
-    ingredients_list = []
-    for item in response.data:
-        # Format: "Quantity Units of Name"
-        ingredient = f"{item['Quantity']} {item['Units']} of {item['Name']}"
-        ingredients_list.append(ingredient)
-    return ", ".join(ingredients_list)
-
-def fetch_user_profile(user_id):
-    response = supabase.table('CustomUsers').select("*").eq('user_id', user_id).execute()
-    if response.data:
-        return response.data[0]
-    return {}
-
-def generate_recipe(user_id, meal_type="lunch"):
-    print(f"Generating {meal_type} recipe for user {user_id}")
-    ingredients_string = fetch_ingredients_for_user(user_id)
-    print("ING - Ingredients string", ingredients_string)
-    user_profile = fetch_user_profile(user_id)
-    print(user_profile)
-    preferences = user_profile.get("preferences", "")
-    diet_plan = user_profile.get("diet_plan", "")
-    
-    if not ingredients_string:
-        return {"error": "No ingredients available in inventory."}
-    
-    # Meal-specific guidance
-    meal_guidance = {
-        "breakfast": "Focus on energizing and nutritious ingredients suitable for starting the day. Consider lighter, easily digestible options.",
-        "lunch": "Create a balanced meal that provides sustained energy for the afternoon. Include a good mix of proteins and vegetables.",
-        "dinner": "Design a satisfying meal that's not too heavy before bedtime. Consider comfort food elements while maintaining nutritional balance."
-    }
-    
-    prompt = f"""
-You are a smart cooking assistant.
-Here are the available ingredients:
-{ingredients_string}
-User preferences: {preferences}
-User diet plan: {diet_plan}
-Meal type: {meal_type}
-Meal guidance: {meal_guidance.get(meal_type, "")}
-
-Please suggest a healthy {meal_type} recipe using these ingredients, following the user's preferences and diet plan.
-Make sure the recipe is appropriate for {meal_type} time.
-Include:
-- Recipe name
-- Ingredients list with quantities
-- Step-by-step instructions
-- Preparation time
-- Macronutrients breakdown
-- Suggested inventory updates after cooking
-
-Respond in valid JSON format like:
-{{
-  "recipe_name": "string",
-  "ingredients": ["ingredient and Quantity", "..."],
-  "instructions": "string",
-  "prep_time": "string",
-  "macros": {{
-    "carbs": "number (only the number in grams)",
-    "fat": "number (only the number in grams)",
-    "protein": "number (only the number in grams)"
-  }},
-  "meal_type": "{meal_type}",
-  "suggested_inventory_update": {{
-    "ingredient_name": new_quantity_after_cooking,
-    "ingredient_name_2": new_quantity_after_cooking
-  }}
-}}
-"""
-    response = model.generate_content(prompt)
-    try:
-        clean_text = clean_json_response(response.text)
-        recipe_json = json.loads(clean_text)
-        print(recipe_json)
-        return recipe_json
-    except json.JSONDecodeError:
-        return {"error": "Invalid JSON returned by Gemini", "raw_response": response.text}
-
-def update_ingredients_inventory(user_id: str, updated_inventory: Dict[str, InventoryUpdateItem]):
-    """
-    Updates the Ingredients Inventory table with new quantities and units.
-    Only updates ingredients that exist in the user's current inventory.
-    Will NOT delete ingredients when quantity is 0 — instead, keeps them with 0 quantity.
-    Args:
-        user_id: User ID
-        updated_inventory: Dict with ingredient names as keys and InventoryUpdateItem as values
-    """
-    current_inventory_response = supabase.table('Ingredients Inventory').select("*").eq('user_id', user_id).execute()
-    
-    if not current_inventory_response.data:
-        print(f"No current inventory found for user {user_id}")
-        return {"updated": 0, "skipped": len(updated_inventory), "errors": []}
-    
-    current_ingredients = {}
-    for item in current_inventory_response.data:
-        current_ingredients[item['Name'].lower()] = item['Name']
-    
-    updated_count = 0
-    skipped_count = 0
-    errors = []
-    
-    for ingredient_name, update_info in updated_inventory.items():
-        ingredient_name_lower = ingredient_name.strip().lower()
-        if ingredient_name_lower not in current_ingredients:
-            print(f"Ingredient '{ingredient_name}' not found in user's inventory. Skipping.")
-            skipped_count += 1
-            continue
-        
-        actual_ingredient_name = current_ingredients[ingredient_name_lower]
-        
-        try:
-            new_qty = float(update_info.quantity)
-            new_units = update_info.units
-            response = supabase.table('Ingredients Inventory') \
-                .update({'Quantity': new_qty, 'Units': new_units}) \
-                .eq('user_id', user_id) \
-                .eq('Name', actual_ingredient_name) \
-                .execute()
-            
-            if response.data:
-                print(f"Updated {actual_ingredient_name} for user {user_id} to quantity {new_qty} {new_units}")
-                updated_count += 1
-            else:
-                error_msg = f"Failed to update {actual_ingredient_name}"
-                print(error_msg)
-                errors.append(error_msg)
-
-        except ValueError as e:
-            error_msg = f"Invalid quantity for {ingredient_name}: {update_info.quantity}. Error: {e}"
-            print(error_msg)
-            errors.append(error_msg)
-        except Exception as e:
-            error_msg = f"Error updating {ingredient_name}: {str(e)}"
-            print(error_msg)
-            errors.append(error_msg)
-    
-    return {
-        "updated": updated_count,
-        "skipped": skipped_count,
-        "errors": errors
-    }
-
-
 # Existing routes
 @app.post("/signup/")
 async def signup(request: SignupRequest):
@@ -259,8 +122,7 @@ async def login(request: LoginRequest):
 @app.post("/generate-recipe/")
 async def generate_recipe_endpoint(request: RecipeRequest):
     try:
-        recipe = generate_recipe(request.user_id, request.meal_type)
-        print("RECIPE:", recipe)
+        recipe = await generate_recipe(request.user_id, request.meal_type)
         if "error" in recipe:
             raise HTTPException(status_code=400, detail=recipe["error"])
         
@@ -269,17 +131,27 @@ async def generate_recipe_endpoint(request: RecipeRequest):
             "recipe": recipe
         }
     except Exception as e:
-        print("ERROR:", e)
+        logger.exception("Recipe generation failed for %s", request.user_id)
         raise HTTPException(status_code=500, detail=f"Failed to generate recipe: {str(e)}")
 
+# Streams the recipe as NDJSON, one {"field": value} line per top-level field as soon as
+# it is complete, so clients can render the name and ingredients while instructions generate
+@app.post("/generate-recipe/stream/")
+async def generate_recipe_stream_endpoint(request: RecipeRequest):
+    async def ndjson():
+        async for field in stream_recipe_fields(request.user_id, request.meal_type):
+            yield orjson.dumps(field) + b"\n"
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
 # New separate inventory update endpoint
 @app.post("/update-inventory/")
 async def update_inventory_endpoint(request: UpdateInventoryRequest):
+    # Checked outside the try, so the 400 is not turned into a 500 below
+    if not request.updated_inventory:
+        raise HTTPException(status_code=400, detail="No inventory updates provided")
+
     try:
-        if not request.updated_inventory:
-            raise HTTPException(status_code=400, detail="No inventory updates provided")
-        
-        result = update_ingredients_inventory(request.user_id, request.updated_inventory)
+        result = await update_ingredients_inventory(request.user_id, request.updated_inventory)
         
         return {
             "success": True,
@@ -287,14 +159,14 @@ async def update_inventory_endpoint(request: UpdateInventoryRequest):
             "details": result
         }
     except Exception as e:
-        print("ERROR:", e)
+        logger.exception("Inventory update failed for %s", request.user_id)
         raise HTTPException(status_code=500, detail=f"Failed to update inventory: {str(e)}")
 
 # Optional: GET route for recipe generation (if you prefer GET with query params)
 @app.get("/generate-recipe/{user_id}")
 async def generate_recipe_get(user_id: str, meal_type: MealType = MealType.lunch):
     try:
-        recipe = generate_recipe(user_id, meal_type)
+        recipe = await generate_recipe(user_id, meal_type)
         if "error" in recipe:
             raise HTTPException(status_code=400, detail=recipe["error"])
         
@@ -307,23 +179,42 @@ async def generate_recipe_get(user_id: str, meal_type: MealType = MealType.lunch
 
 @app.get("/fetch-user/{user_id}")
 async def fetch_user(user_id: str):
-    response = supabase.table('CustomUsers').select("*").eq('user_id', user_id).execute()
+    response = await async_supabase.table('CustomUsers').select("user_id,username,email,preferences,diet_plan").eq('user_id', user_id).execute()
 
     if response.data:
         return {"user": response.data[0]}
     else:
         return {"message": "User not found."}
 
-# Initialize extractor
-bill_extractor = BillItemExtractor(API_KEY)
-
-def extract_bill_items(image_path: str, user_id: Optional[str] = None):
+# Built on first use rather than at import, so worker startup does no Gemini setup
+@functools.lru_cache(maxsize=1)
+def get_bill_extractor():
+    return BillItemExtractor(API_KEY)
+
+# Phone photos of receipts are a few MB; anything far larger is rejected
+MAX_BILL_UPLOAD_BYTES = int(os.getenv("MAX_BILL_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Room for the multipart boundaries and part headers around the image
+_MULTIPART_OVERHEAD = 64 * 1024
+
+# Starlette spools the whole multipart body before the route runs, so a declared oversized
+# upload has to be turned away here, before any of it is read
+@app.middleware("http")
+async def limit_bill_upload_size(request: Request, call_next):
+    if request.url.path == "/extract-bill-upload/":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_BILL_UPLOAD_BYTES + _MULTIPART_OVERHEAD:
+            return ORJSONResponse(status_code=413, content={"detail": "Image too large."})
+    return await call_next(request)
+
+def extract_bill_items(image_bytes: bytes, mime_type: str, user_id: Optional[str] = None, display: bool = False):
     """
-    Extract items from a bill image and return parsed result.
+    Extract items from bill image bytes and return parsed result.
     """
     try:
-        json_result = bill_extractor.extract_and_format(image_path)
-        return json.loads(json_result)
+        # Build the result dict directly; no dump-to-string and parse-back round trip
+        extractor = get_bill_extractor()
+        items = extractor.extract_items_from_bytes(image_bytes, mime_type)
+        return extractor.create_output(items, include_display=display)
     except Exception as e:
         return {
             "success": False,
@@ -335,31 +226,31 @@ def extract_bill_items(image_path: str, user_id: Optional[str] = None):
 @app.post("/extract-bill-upload/")
 async def extract_bill_upload_endpoint(
     file: UploadFile = File(...),
-    user_id: Optional[str] = None
+    user_id: Optional[str] = None,
+    display: bool = False
 ):
     try:
         # Validate file type
         if not file.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="Invalid file type. Upload an image.")
 
-        # Save the uploaded image to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-            temp_file.write(await file.read())
-            temp_file_path = temp_file.name
+        # Bodies without a Content-Length (chunked) get past the middleware above and are
+        # already spooled by now; this still keeps an oversized image out of memory and away
+        # from Gemini. The bytes then go straight to the extractor with no temp file round trip
+        image_bytes = bytearray()
+        while chunk := await file.read(64 * 1024):
+            image_bytes += chunk
+            if len(image_bytes) > MAX_BILL_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Image too large.")
+        image_bytes = bytes(image_bytes)
 
-        try:
-            # Extract bill items
-            result = extract_bill_items(temp_file_path, user_id)
+        # Extract bill items; the Gemini call is blocking, so keep it off the event loop
+        result = await asyncio.to_thread(extract_bill_items, image_bytes, file.content_type, user_id, display)
 
-            if not result.get("success"):
-                raise HTTPException(status_code=400, detail=result.get("error", "Extraction failed"))
+        if not result.get("success"):
+            raise HTTPException(status_code=400, detail=result.get("error", "Extraction failed"))
 
-            return result
-
-        finally:
-            # Delete temp file
-            if os.path.exists(temp_file_path):
-                os.unlink(temp_file_path)
+        return result
 
     except HTTPException:
         raise
@@ -368,19 +259,20 @@ async def extract_bill_upload_endpoint(
 
 
 @app.post("/detect-items/")
-async def detect_items(file: UploadFile = File(...)):
-    print("HERE")
+async def detect_items(request: Request, file: UploadFile = File(...)):
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="Invalid file type. Upload an image.")
 
-    image_bytes = await file.read()
-    img = Image.open(io.BytesIO(image_bytes))
-    results = yolo_model(img)
-    detections = results.pandas().xyxy[0].to_dict(orient="records")
-
-    item_counts = {}
-    for det in detections:
-        name = det["name"].title()  # Capitalize each word
-        item_counts[name] = item_counts.get(name, 0) + 1
+    # Decode straight from the upload's spooled file; draft() lets libjpeg
+    # downscale during decode since the model only needs 640px anyway
+    img = Image.open(file.file)
+    img.draft("RGB", (IMG_SIZE, IMG_SIZE))
+    img = np.asarray(img.convert("RGB"))
+    detections = await request.app.state.detection_batcher.detect(img)
+
+    class_ids, counts = np.unique(detections[:, 5].astype(int), return_counts=True)
+    # Capitalize each word
+    names = request.app.state.yolo.names
+    item_counts = {names[cls].title(): int(count) for cls, count in zip(class_ids, counts)}
 
     return {"items": item_counts}
\ No newline at end of file
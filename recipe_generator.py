@@ -1,123 +1,333 @@
-import re
-import json
+import os
+import asyncio
 import logging
+from typing import Dict, List
+import numpy as np
+import orjson
+import jiter
 import google.generativeai as genai
-from supabase_client import supabase
-import os 
+from google.api_core.exceptions import ResourceExhausted
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from supabase_client import async_supabase
 
-# Gemini API configuration
-api_key = os.getenv( )
-genai.configure(api_key="")
-model = genai.GenerativeModel("gemini-1.5-flash")
-
-# Recipe generator function
-def clean_json_response(text):
-    clean_text = re.sub(r'```(?:json)?', '', text).strip()
-    clean_text = re.sub(r'```$', '', clean_text).strip()
-    return clean_text
-
-def fetch_ingredients_for_user(user_id):
-    response = supabase.table('Ingredients Inventory').select("*").eq('user_id', user_id).execute()
-
-    ingredients_list = []
-    for item in response.data:
-        ingredient = f"{item['Quantity']}g of {item['Name']}"
-        ingredients_list.append(ingredient)
-
-    return ", ".join(ingredients_list)
-
-def fetch_user_profile(user_id):
-    print("HERE")
-    response = supabase.table('CustomUsers').select("*").eq('user_id', user_id).execute()
-    if response.data:
-        return response.data[0]
-    return {}
-
-def generate_recipe(user_id):
-    print("HERE")
-    ingredients_string = fetch_ingredients_for_user(user_id)
-    user_profile = fetch_user_profile(user_id)
-    print(user_profile)
-    preferences = user_profile.get("preferences", "")
-    diet_plan = user_profile.get("diet_plan", "")
+load_dotenv()
 
-    if not ingredients_string:
-        return {"error": "No ingredients available in inventory."}
+logger = logging.getLogger(__name__)
+
+API_KEY = os.getenv('GEMINI_API')
+if not API_KEY:
+    raise RuntimeError("❌ GEMINI_API_KEY not found in .env")
+
+# Structured output schema; Gemini decodes against it, so the reply is always valid JSON.
+# Keys are abbreviated to save output tokens (the legend is in the system instruction)
+# and expanded back to the public names by _expand_keys.
+class Macros(BaseModel):
+    c: float
+    f: float
+    p: float
+
+class InventoryChange(BaseModel):
+    i: str
+    q: float
+
+class RecipeSchema(BaseModel):
+    n: str
+    ing: List[str]
+    ins: str
+    t: str
+    m: Macros
+    mt: str
+    # Schemas cannot express free-form keys, so this is a list; it is turned back into a dict below
+    inv: List[InventoryChange]
 
-    prompt = f"""
+_RECIPE_KEYS = {
+    "n": "recipe_name",
+    "ing": "ingredients",
+    "ins": "instructions",
+    "t": "prep_time",
+    "m": "macros",
+    "mt": "meal_type",
+    "inv": "suggested_inventory_update"
+}
+_MACRO_KEYS = {"c": "carbs", "f": "fat", "p": "protein"}
+
+# Meal-specific guidance
+_MEAL_GUIDANCE = {
+    "breakfast": "Focus on energizing and nutritious ingredients suitable for starting the day. Consider lighter, easily digestible options.",
+    "lunch": "Create a balanced meal that provides sustained energy for the afternoon. Include a good mix of proteins and vegetables.",
+    "dinner": "Design a satisfying meal that's not too heavy before bedtime. Consider comfort food elements while maintaining nutritional balance."
+}
+
+# Everything that is the same for every request lives in the system instruction, so each
+# call only sends the short per-user prompt below after an identical, cacheable prefix
+_SYSTEM_INSTRUCTION = """
 You are a smart cooking assistant.
+Suggest a healthy recipe using the available ingredients, following the user's preferences and diet plan.
+Make sure the recipe is appropriate for the requested meal type.
+Meal guidance:
+""" + "\n".join(f"- {meal}: {guidance}" for meal, guidance in _MEAL_GUIDANCE.items()) + """
+Respond with these fields:
+- n: recipe name
+- ing: ingredients list with quantities
+- ins: step-by-step instructions
+- t: preparation time
+- m: macronutrients in grams (c: carbs, f: fat, p: protein)
+- mt: the meal type
+- inv: suggested inventory updates, one entry per used ingredient with i: the ingredient name
+  as it appears in the inventory and q: the quantity left after cooking, in the inventory's units.
+  Subtract whole items for ingredients counted in pieces (e.g. eggs), not grams.
+"""
 
+# Per-request prompt; only the fields in braces change
+_RECIPE_PROMPT = """
 Here are the available ingredients:
-{ingredients_string}
-
+{ingredients}
 User preferences: {preferences}
 User diet plan: {diet_plan}
-
-Please suggest a healthy recipe using these ingredients, following the user's preferences and diet plan.
-Include:
-- Recipe name
-- Ingredients list with quantities
-- Step-by-step instructions
-- Preparation time
-
-Respond in valid JSON format like:
-{{
-  "recipe_name": "string",
-  "ingredients": ["ingredient and Quantity", "..."],
-  "instructions": "string",
-  "prep_time": "string"
-}}
+Meal type: {meal_type}
 """
 
-    response = model.generate_content(prompt)
+# Gemini API configuration
+genai.configure(api_key=API_KEY)
+# One model for the whole process; it lazily creates and then reuses its async client
+model = genai.GenerativeModel(
+    "gemini-1.5-flash",
+    system_instruction=_SYSTEM_INSTRUCTION,
+    generation_config={"response_mime_type": "application/json", "response_schema": RecipeSchema}
+)
+
+# Stay under the tier's request quota instead of letting bursts hit 429s
+_gemini_semaphore = asyncio.Semaphore(int(os.getenv("GEMINI_MAX_CONCURRENCY", "20")))
+
+class InventoryUpdateItem(BaseModel):
+    quantity: float
+    units: str
+
+# Short-lived read cache of the prompt inputs; dropped on every recipe-driven inventory update
+_context_cache = TTLCache(maxsize=10_000, ttl=30)
+# Finished recipes keyed by every prompt input; the ingredient list is represented by the
+# content_hash that Postgres keeps alongside it in ingredient_summary
+_recipe_cache = TTLCache(maxsize=10_000, ttl=3600)
+
+# Near-duplicate inputs (a few grams more or less of something) reuse an earlier recipe
+# for the same user and meal type when their embeddings are at least this similar
+EMBEDDING_MODEL = "models/text-embedding-004"
+SEMANTIC_THRESHOLD = float(os.getenv("RECIPE_SEMANTIC_THRESHOLD", "0.93"))
+SEMANTIC_BUCKET_SIZE = 32
+# (user_id, meal_type) -> (unit-norm embedding matrix, (recipe, quantities) entries in the same
+# row order), where quantities is the name_norm -> Quantity map the recipe was generated against
+_semantic_cache = TTLCache(maxsize=10_000, ttl=3600)
+
+async def embed_text(text):
+    result = await asyncio.to_thread(
+        genai.embed_content, model=EMBEDDING_MODEL, content=text, task_type="semantic_similarity"
+    )
+    vector = np.asarray(result["embedding"], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def semantic_lookup(bucket_key, vector):
+    bucket = _semantic_cache.get(bucket_key)
+    if bucket is None:
+        return None
+    vectors, entries = bucket
+    # Rows are unit-norm, so the dot product is the cosine similarity
+    scores = vectors @ vector
+    best = int(scores.argmax())
+    return entries[best] if scores[best] >= SEMANTIC_THRESHOLD else None
+
+def semantic_store(bucket_key, vector, recipe, quantities):
+    vectors, entries = _semantic_cache.get(bucket_key, (np.empty((0, len(vector)), dtype=np.float32), []))
+    vectors = np.vstack([vectors, vector])[-SEMANTIC_BUCKET_SIZE:]
+    entries = (entries + [(recipe, quantities)])[-SEMANTIC_BUCKET_SIZE:]
+    _semantic_cache[bucket_key] = (vectors, entries)
+
+def rederive_inventory_update(update, old_quantities, quantities):
+    """
+    Carry a reused recipe's inventory update over to the current stock: the stored values
+    are what was left of old_quantities, so the amounts used are subtracted from the
+    current quantities instead. Returns None if any ingredient is no longer in stock.
+    """
+    rederived = {}
+    for name, left in update.items():
+        key = name.strip().lower()
+        if left is None or key not in old_quantities or key not in quantities:
+            return None
+        used = old_quantities[key] - left
+        rederived[name] = max(quantities[key] - used, 0)
+    return rederived
+
+async def fetch_recipe_context(user_id):
+    cached = _context_cache.get(user_id)
+    if cached is not None:
+        return cached
+    # One RPC returns the trigger-maintained "Quantity Units of Name, ..." summary, its hash and the profile fields
+    response = await async_supabase.rpc('get_recipe_context', {"p_user": user_id}).execute()
+    context = response.data or {}
+    _context_cache[user_id] = context
+    return context
+
+def _expand_keys(recipe):
+    # Also folds inv's [{i, q}] list back into {name: quantity}; entries without a name yet are still being streamed
+    recipe = {_RECIPE_KEYS.get(key, key): value for key, value in recipe.items()}
+    if "macros" in recipe:
+        recipe["macros"] = {_MACRO_KEYS.get(key, key): value for key, value in recipe["macros"].items()}
+    if "suggested_inventory_update" in recipe:
+        recipe["suggested_inventory_update"] = {
+            change["i"]: change.get("q") for change in recipe["suggested_inventory_update"] if "i" in change
+        }
+    return recipe
 
+async def stream_recipe(user_id, meal_type="lunch", partial=True):
+    """
+    Generate a recipe, yielding progressively more complete versions of it while Gemini
+    is still writing when partial is set. The last item yielded is the finished recipe
+    (or an error dict).
+    """
+    logger.debug("Generating %s recipe for user %s", meal_type, user_id)
+    context = await fetch_recipe_context(user_id)
+    ingredients_string = context.get("ingredients") or ""
+    preferences = context.get("preferences") or ""
+    diet_plan = context.get("diet_plan") or ""
+    quantities = context.get("quantities") or {}
+    
+    if not ingredients_string:
+        yield {"error": "No ingredients available in inventory."}
+        return
+    
+    prompt = _RECIPE_PROMPT.format(
+        ingredients=ingredients_string,
+        preferences=preferences,
+        diet_plan=diet_plan,
+        meal_type=meal_type
+    )
+    cache_key = (user_id, meal_type, context.get("content_hash"), preferences, diet_plan)
+    cached = _recipe_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    bucket_key = (user_id, meal_type)
     try:
-        clean_text = clean_json_response(response.text)
-        recipe_json = json.loads(clean_text)
-        print(recipe_json)
-        # Update inventory after recipe is generated
-        if "post meal inventory change" in recipe_json:
-            inventory_changes = recipe_json["post meal inventory change"]
-            if isinstance(inventory_changes, str):
-                inventory_changes = json.loads(inventory_changes)
-            update_ingredients_inventory(user_id, inventory_changes)
-        return recipe_json
-    except json.JSONDecodeError:
-        return {"error": "Invalid JSON returned by Gemini", "raw_response": response.text}
-
-def update_ingredients_inventory(user_id, inventory_changes):
+        vector = await embed_text(f"{ingredients_string}\n{preferences}\n{diet_plan}")
+    except Exception as e:
+        # The semantic cache is an optimisation; fall through to Gemini without it
+        logger.warning("Embedding failed, skipping semantic cache: %s", e)
+        vector = None
+    if vector is not None:
+        entry = semantic_lookup(bucket_key, vector)
+        if entry is not None:
+            cached, old_quantities = entry
+            update = rederive_inventory_update(cached["suggested_inventory_update"], old_quantities, quantities)
+            # Only reused while every ingredient it draws on is still in the inventory.
+            # Not copied into the exact cache, so it never stands in for a generated result.
+            if update is not None:
+                yield {**cached, "suggested_inventory_update": update, "reused": True}
+                return
+
+    streamed = False
+    # 429s are retried with backoff, including ones raised mid-stream, but only until a
+    # snapshot has been yielded: a restart would contradict what the caller already has
+    retrying = AsyncRetrying(
+        retry=retry_if_exception(lambda e: isinstance(e, ResourceExhausted) and not streamed),
+        wait=wait_random_exponential(multiplier=1, max=30),
+        stop=stop_after_attempt(5),
+        reraise=True
+    )
+    async for attempt in retrying:
+        with attempt:
+            # Held until the whole body is read, so GEMINI_MAX_CONCURRENCY also bounds open streams
+            async with _gemini_semaphore:
+                response = await model.generate_content_async(prompt, stream=partial)
+                if partial:
+                    buf = b""
+                    async for chunk in response:
+                        buf += chunk.text.encode()
+                        try:
+                            # jiter closes any open strings/containers, so fields surface as soon as they start
+                            snapshot = jiter.from_json(buf, partial_mode="trailing-strings")
+                        except ValueError:
+                            continue
+                        if isinstance(snapshot, dict):
+                            streamed = True
+                            yield _expand_keys(snapshot)
+                    text = buf.decode()
+                else:
+                    text = response.text
+
+    try:
+        recipe_json = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        # Only reachable if the reply was cut off (e.g. max tokens); the schema rules out malformed JSON
+        yield {"error": "Invalid JSON returned by Gemini", "raw_response": text}
+        return
+    recipe_json = _expand_keys(recipe_json)
+    _recipe_cache[cache_key] = recipe_json
+    if vector is not None:
+        semantic_store(bucket_key, vector, recipe_json, quantities)
+    yield recipe_json
+
+async def stream_recipe_fields(user_id, meal_type="lunch"):
     """
-    Updates the Ingredients Inventory table to match the new quantities after cooking.
-    Deletes the ingredient if quantity becomes 0.
-    inventory_changes: list of dicts like {"ingredient": "Carrot", "quantity": 2}
+    Yield the recipe one top-level field at a time as {field: value} dicts, each as soon
+    as Gemini has finished writing it. Errors come through as {"error": ...}.
     """
-    if not isinstance(inventory_changes, list):
-        print("inventory_changes is not a list:", inventory_changes)
+    emitted = set()
+    recipe = {}
+    try:
+        async for recipe in stream_recipe(user_id, meal_type):
+            # A field is complete once Gemini has started on the next one
+            for key in list(recipe)[:-1]:
+                if key not in emitted:
+                    emitted.add(key)
+                    yield {key: recipe[key]}
+    except Exception as e:
+        # The 200 headers are already sent, so the failure has to travel as the last record
+        logger.exception("Streaming recipe generation failed for %s", user_id)
+        yield {"error": f"Failed to generate recipe: {str(e)}"}
         return
-    for change in inventory_changes:
-        print("CHANGE ITEM:", change)
-        if not isinstance(change, dict) or "ingredient" not in change or "quantity" not in change:
-            print("Skipping invalid change item:", change)
-            continue
-        name = change["ingredient"].strip().title()
-        try:
-            new_qty = int(change["quantity"])
-        except Exception as e:
-            print(f"Invalid quantity for {name}: {change['quantity']}. Error: {e}")
-            continue
-        print(f"Setting {name} for user {user_id} to quantity {new_qty}")  # Debug print
-        if new_qty > 0:
-            response = supabase.table('Ingredients Inventory') \
-                .update({'Quantity': new_qty}) \
-                .eq('user_id', user_id) \
-                .eq('Name', name) \
-                .execute()
-            print("Update response:", response)
-        else:
-            response = supabase.table('Ingredients Inventory') \
-                .delete() \
-                .eq('user_id', user_id) \
-                .eq('Name', name) \
-                .execute()
-            print(f"Deleted {name} for user {user_id}")
-            print("Delete response:", response)
+    for key, value in recipe.items():
+        if key not in emitted:
+            yield {key: value}
+
+async def generate_recipe(user_id, meal_type="lunch"):
+    recipe = None
+    async for recipe in stream_recipe(user_id, meal_type, partial=False):
+        pass
+    return recipe
+
+async def update_ingredients_inventory(user_id: str, updated_inventory: Dict[str, InventoryUpdateItem]):
+    """
+    Updates the Ingredients Inventory table with new quantities and units.
+    Only updates ingredients that exist in the user's current inventory.
+    Will NOT delete ingredients when quantity is 0 — instead, keeps them with 0 quantity.
+    Args:
+        user_id: User ID
+        updated_inventory: Dict with ingredient names as keys and InventoryUpdateItem as values
+    """
+    # Matching and updating happen in one SQL call instead of a SELECT plus one UPDATE per item;
+    # names are matched against the normalised name_norm column, so they are passed as-is
+    items = [
+        {"name": ingredient_name, "qty": float(update_info.quantity), "units": update_info.units}
+        for ingredient_name, update_info in updated_inventory.items()
+    ]
+    try:
+        response = await async_supabase.rpc('bulk_update_inventory', {"p_user": user_id, "p_items": items}).execute()
+    except Exception as e:
+        error_msg = f"Error updating inventory for user {user_id}: {str(e)}"
+        logger.exception("Error updating inventory for user %s", user_id)
+        return {"updated": 0, "skipped": 0, "errors": [error_msg]}
+
+    _context_cache.pop(user_id, None)
+    for cache in (_recipe_cache, _semantic_cache):
+        for key in [key for key in cache if key[0] == user_id]:
+            cache.pop(key, None)
+    counts = response.data[0] if response.data else {"updated": 0, "skipped": len(items)}
+    logger.debug("Updated %d ingredients for user %s, skipped %d", counts['updated'], user_id, counts['skipped'])
+    return {
+        "updated": counts["updated"],
+        "skipped": counts["skipped"],
+        "errors": []
+    }
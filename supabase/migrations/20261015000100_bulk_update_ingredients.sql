@@ -0,0 +1,14 @@
+-- Apply a batch of ingredient edits in a single statement.
+-- Only rows owned by p_user are touched; fields left null keep their current value.
+create or replace function bulk_update_ingredients(p_user uuid, p_items jsonb)
+returns setof "Ingredients Inventory"
+language sql
+as $$
+  update "Ingredients Inventory" i
+     set "Name" = coalesce(x.name, i."Name"),
+         "Quantity" = coalesce(x.quantity, i."Quantity")
+    from jsonb_to_recordset(p_items) as x(id bigint, name text, quantity int)
+   where i.id = x.id
+     and i.user_id = p_user
+  returning i.*;
+$$;
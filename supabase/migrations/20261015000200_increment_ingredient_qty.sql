@@ -0,0 +1,10 @@
+-- Atomically add delta to an ingredient's quantity, never going below zero.
+create or replace function increment_ingredient_qty(ing_id int, delta int)
+returns setof "Ingredients Inventory"
+language sql
+as $$
+  update "Ingredients Inventory"
+     set "Quantity" = greatest(0, "Quantity" + delta)
+   where id = ing_id
+  returning *;
+$$;
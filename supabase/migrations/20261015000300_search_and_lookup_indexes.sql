@@ -0,0 +1,32 @@
+-- Let leading-wildcard ILIKE in search_ingredients use an index instead of a scan.
+create extension if not exists pg_trgm;
+create index if not exists idx_ing_name_trgm on "Ingredients Inventory" using gin ("Name" gin_trgm_ops);
+
+-- Every inventory read filters by user_id.
+create index if not exists idx_ing_user on "Ingredients Inventory" (user_id);
+
+-- signup_user used to check only usernames, so existing data can hold duplicate emails
+-- (and, racing signups, usernames). Stop with the offending values instead of a bare
+-- unique-violation from the index build; merging accounts is a manual decision.
+do $$
+declare
+  dup_emails text;
+  dup_usernames text;
+begin
+  select string_agg(email, ', ') into dup_emails
+    from (select email from "CustomUsers" where email is not null group by email having count(*) > 1) d;
+  select string_agg(username, ', ') into dup_usernames
+    from (select username from "CustomUsers" where username is not null group by username having count(*) > 1) d;
+  if dup_emails is not null or dup_usernames is not null then
+    raise exception 'Duplicate "CustomUsers" rows block the unique indexes. emails: %; usernames: %',
+      coalesce(dup_emails, 'none'), coalesce(dup_usernames, 'none')
+      using hint = 'Merge or delete the extra accounts, then re-run this migration.';
+  end if;
+end;
+$$;
+
+-- login_user looks up by email and signup_user by username. On the raw columns, so
+-- uniqueness matches login_user's case-sensitive eq("email") lookup and the index
+-- serves it; lower() indexes would also fail to build on existing case-variant rows.
+create unique index if not exists idx_users_email on "CustomUsers" (email);
+create unique index if not exists idx_users_username on "CustomUsers" (username);
@@ -0,0 +1,20 @@
+-- Apply post-recipe inventory quantities in one statement.
+-- Names match case-insensitively; items not in the user's inventory count as skipped.
+create or replace function bulk_update_inventory(p_user uuid, p_items jsonb)
+returns table(updated int, skipped int)
+language sql
+as $$
+  with changes as (
+    select * from jsonb_to_recordset(p_items) as x(name text, qty float, units text)
+  ), applied as (
+    update "Ingredients Inventory" i
+       set "Quantity" = c.qty,
+           "Units" = c.units
+      from changes c
+     where i.user_id = p_user
+       and lower(i."Name") = lower(c.name)
+    returning lower(i."Name") as name
+  )
+  select (select count(distinct name) from applied)::int,
+         (select count(*) from changes c where lower(c.name) not in (select name from applied))::int;
+$$;
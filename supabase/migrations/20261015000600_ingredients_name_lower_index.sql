@@ -0,0 +1,2 @@
+-- bulk_update_inventory matches on (user_id, lower("Name")); index that expression.
+create index if not exists ingredients_name_lower_idx on "Ingredients Inventory" (user_id, lower("Name"));
@@ -0,0 +1,10 @@
+-- The recipe prompt's ingredient list, formatted as "Quantity Units of Name, ...".
+create or replace function get_ingredients_string(p_user uuid)
+returns text
+language sql
+stable
+as $$
+  select string_agg(format('%s %s of %s', "Quantity", "Units", "Name"), ', ' order by id)
+    from "Ingredients Inventory"
+   where user_id = p_user;
+$$;
@@ -0,0 +1,13 @@
+-- Everything the recipe prompt needs for a user in one round trip:
+-- the formatted ingredient list plus the profile fields.
+create or replace function get_recipe_context(p_user uuid)
+returns jsonb
+language sql
+stable
+as $$
+  select jsonb_build_object(
+    'ingredients', get_ingredients_string(p_user),
+    'preferences', (select preferences from "CustomUsers" where user_id = p_user),
+    'diet_plan', (select diet_plan from "CustomUsers" where user_id = p_user)
+  );
+$$;
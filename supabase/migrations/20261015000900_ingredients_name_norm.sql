@@ -0,0 +1,28 @@
+-- Canonical ingredient name, computed once at write time, so inventory matching
+-- ignores case and stray whitespace without normalising in Python.
+alter table "Ingredients Inventory"
+  add column if not exists name_norm text generated always as (lower(btrim("Name"))) stored;
+
+create index if not exists ingredients_name_norm_idx on "Ingredients Inventory" (user_id, name_norm);
+-- Superseded by the index above.
+drop index if exists ingredients_name_lower_idx;
+
+create or replace function bulk_update_inventory(p_user uuid, p_items jsonb)
+returns table(updated int, skipped int)
+language sql
+as $$
+  with changes as (
+    select lower(btrim(x.name)) as name, x.qty, x.units
+      from jsonb_to_recordset(p_items) as x(name text, qty float, units text)
+  ), applied as (
+    update "Ingredients Inventory" i
+       set "Quantity" = c.qty,
+           "Units" = c.units
+      from changes c
+     where i.user_id = p_user
+       and i.name_norm = c.name
+    returning i.name_norm as name
+  )
+  select (select count(distinct name) from applied)::int,
+         (select count(*) from changes c where c.name not in (select name from applied))::int;
+$$;
@@ -0,0 +1,97 @@
+-- Per-user ingredient list for the recipe prompt, kept current by triggers so the
+-- recipe path reads one row instead of aggregating the inventory on every request.
+-- content_hash changes exactly when summary_text does and keys the recipe cache.
+-- quantities maps name_norm to "Quantity", so a reused recipe's inventory update can be
+-- re-derived against the current stock.
+create table if not exists ingredient_summary (
+  user_id uuid primary key,
+  summary_text text,
+  content_hash text not null,
+  quantities jsonb
+);
+
+-- Only reachable through the security definer functions below; no direct API access.
+alter table ingredient_summary enable row level security;
+revoke all on ingredient_summary from anon, authenticated;
+
+create or replace function refresh_ingredient_summary(p_users uuid[])
+returns void
+language sql
+security definer
+set search_path = public
+as $$
+  insert into ingredient_summary (user_id, summary_text, content_hash, quantities)
+  select u.user_id, s.summary_text, md5(coalesce(s.summary_text, '')), q.quantities
+    from unnest(p_users) as u(user_id)
+   cross join lateral (select get_ingredients_string(u.user_id) as summary_text) s
+   cross join lateral (
+     select jsonb_object_agg(name_norm, "Quantity") as quantities
+       from "Ingredients Inventory"
+      where user_id = u.user_id and name_norm is not null
+   ) q
+  on conflict (user_id) do update
+    set summary_text = excluded.summary_text,
+        content_hash = excluded.content_hash,
+        quantities = excluded.quantities;
+$$;
+-- Internal to the triggers; not exposed as an RPC.
+revoke execute on function refresh_ingredient_summary(uuid[]) from public, anon, authenticated;
+
+-- Statement-level with transition tables, so a bulk update refreshes each user once.
+-- Rows without a user_id have no summary (it is the primary key) and are skipped.
+create or replace function ingredient_summary_trigger()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  if tg_op = 'INSERT' then
+    perform refresh_ingredient_summary(array(select distinct user_id from new_rows where user_id is not null));
+  elsif tg_op = 'DELETE' then
+    perform refresh_ingredient_summary(array(select distinct user_id from old_rows where user_id is not null));
+  else
+    perform refresh_ingredient_summary(array(
+      select user_id from new_rows where user_id is not null
+      union
+      select user_id from old_rows where user_id is not null
+    ));
+  end if;
+  return null;
+end;
+$$;
+
+drop trigger if exists ingredient_summary_ins on "Ingredients Inventory";
+create trigger ingredient_summary_ins after insert on "Ingredients Inventory"
+  referencing new table as new_rows
+  for each statement execute function ingredient_summary_trigger();
+
+drop trigger if exists ingredient_summary_upd on "Ingredients Inventory";
+create trigger ingredient_summary_upd after update on "Ingredients Inventory"
+  referencing old table as old_rows new table as new_rows
+  for each statement execute function ingredient_summary_trigger();
+
+drop trigger if exists ingredient_summary_del on "Ingredients Inventory";
+create trigger ingredient_summary_del after delete on "Ingredients Inventory"
+  referencing old table as old_rows
+  for each statement execute function ingredient_summary_trigger();
+
+-- Backfill existing inventories.
+select refresh_ingredient_summary(array(select distinct user_id from "Ingredients Inventory" where user_id is not null));
+
+-- security definer so it can read ingredient_summary past RLS, for the requested user only.
+create or replace function get_recipe_context(p_user uuid)
+returns jsonb
+language sql
+stable
+security definer
+set search_path = public
+as $$
+  select jsonb_build_object(
+    'ingredients', (select summary_text from ingredient_summary where user_id = p_user),
+    'content_hash', (select content_hash from ingredient_summary where user_id = p_user),
+    'quantities', (select quantities from ingredient_summary where user_id = p_user),
+    'preferences', (select preferences from "CustomUsers" where user_id = p_user),
+    'diet_plan', (select diet_plan from "CustomUsers" where user_id = p_user)
+  );
+$$;
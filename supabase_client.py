@@ -1,22 +1,44 @@
 # ---------- supabase_client.py ----------
-from supabase import create_client
+from supabase import AsyncClient, AsyncClientOptions
+import importlib.util
+import httpx
+import logging
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# httpx defaults to a 10-connection pool, which serialises concurrent handlers
+POOL_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=50, keepalive_expiry=30)
+POSTGREST_TIMEOUT = 10
+
+# One pooled connection set for every PostgREST call, closed in the app lifespan.
+# HTTP/2 lets concurrent queries (e.g. the recipe fetches) share a connection; it needs the h2 package.
+http_client = httpx.AsyncClient(
+    limits=POOL_LIMITS,
+    timeout=POSTGREST_TIMEOUT,
+    http2=importlib.util.find_spec("h2") is not None
+)
+
+# Non-blocking client for use inside async request handlers
+async_supabase = AsyncClient(SUPABASE_URL, SUPABASE_KEY, options=AsyncClientOptions(
+    postgrest_client_timeout=POSTGREST_TIMEOUT,
+    httpx_client=http_client
+))
 
-#code to test supabase connectivity (successful)
-try:
-    response = supabase.table('Ingredients Inventory').select("*").limit(1).execute()
+async def check_connection():
+    """Probe Supabase once; called from the app lifespan when SUPABASE_HEALTHCHECK is set."""
+    try:
+        response = await async_supabase.table('Ingredients Inventory').select("id").limit(1).execute()
 
-    if response.data is not None:
-        print("✅ Supabase connection successful!")
-    else:
-        print("⚠️ Connected, but no data found.")
-except Exception as e:
-    print(f"❌ Supabase connection failed: {e}")
\ No newline at end of file
+        if response.data is not None:
+            logger.info("Supabase connection successful")
+        else:
+            logger.warning("Supabase connected, but no data found")
+    except Exception as e:
+        logger.error("Supabase connection failed: %s", e)
\ No newline at end of file